@@ -1,36 +1,53 @@
+import concurrent.futures  # Import the concurrent.futures library for running NPC generation in parallel
+import functools  # Import the functools library for memoizing the function templates
+import hashlib  # Import the hashlib library for deriving a seed from the form inputs
 import streamlit as st  # Import the Streamlit library for building the web app
 from openai import OpenAI  # Import the OpenAI library for accessing the GPT-3 API
-import json  # Import the json library for parsing JSON data
-import numpy as np  # Import the numpy library for numerical operations
+import httpx  # Import the httpx library for configuring the OpenAI HTTP connection pool
+import orjson  # Import the orjson library for fast JSON parsing
+import random  # Import the random library for sampling NPC traits
 from npc import NPC  # Import the NPC class from the npc module
 
-# Read the secret key from the ".secrets" file
-with open(".secrets", "r") as f:
-    secret_key = f.read()  # Read the contents of the file and store it in the secret_key variable
+@st.cache_resource(show_spinner=False)
+def load_secret_key():
+    """
+    Read the OpenAI API key from the ".secrets" file once and reuse it across Streamlit reruns.
+
+    Returns:
+        str: The API key without surrounding whitespace.
+    """
+    with open(".secrets", "r") as f:
+        return f.read().strip()  # Read the contents of the file, dropping the trailing newline so it does not end up in the Authorization header
+
+secret_key = load_secret_key()  # Store the API key in the secret_key variable
 
 downscale_factor = 1  # Set the downscale factor to 1 (used for scaling the number of characteristics, occupations, and motivating entities)
+max_name_retries = 3  # Set the number of times a duplicate NPC is regenerated before its name is made unique with a suffix
 
+@functools.lru_cache(maxsize=64)
 def create_custom_function_template(num_personas, num_occupations, num_motivating_entities):
     """
     Create a custom function template for generating NPC characteristics.
 
+    The templates are memoized per set of counts, so callers must not mutate the returned templates.
+
     Args:
         num_personas (int): The number of personas to generate.
         num_occupations (int): The number of occupations to generate.
         num_motivating_entities (int): The number of motivating entities to generate.
 
     Returns:
-        list: A list containing the function template for generating NPC characteristics.
+        tuple: A tuple containing the function template for generating NPC characteristics.
     """
-    function_templates = [
+    function_templates = (
         {
             "name": "npc_world_builder",  # Name of the function template
-            "description": """Generate unique lists of personas, occupations, and motivations for NPCs based on the game's setting, mood, feelings, and additional notes. Ensure each individual keyword within the group is unique it each other can be universally mixed-and-match across the different lists. I.e, the individual personas can be combined across occupations, etc.
+            "description": f"""Generate unique lists of personas, occupations, and motivations for NPCs based on the game's setting, mood, feelings, and additional notes. Ensure each individual keyword within the group is unique it each other can be universally mixed-and-match across the different lists. I.e, the individual personas can be combined across occupations, etc.
 
             Objectives:
             Create {num_personas} number of personas, each diverse in their own right
             Create {num_occupations} number of occupations, each diverse yet realistically important to the world/story
-            Create {num_motivating_entities} number of occupations, each diverse yet makes sense from thematic perspective in this world.
+            Create {num_motivating_entities} number of motivating entities, each diverse yet makes sense from thematic perspective in this world.
             """,  # Description of the function template
             "parameters": {  # Parameters of the function template
                 "type": "object",  # Type of the parameters (object)
@@ -70,16 +87,70 @@ def create_custom_function_template(num_personas, num_occupations, num_motivatin
                 },
                 "required": ["personas", "occupations", "motivating_entities"]  # Required properties for the parameters object
             }
-        }
-    ]
-    return function_templates  # Return the function templates list
+        },
+    )
+    return function_templates  # Return the function templates tuple
 
-def generate_lists(api_key, game_details):
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key):
     """
-    Call the OpenAI API to generate lists of personas, occupations, and motivations based on the provided game details.
+    Create an OpenAI client once per API key and share it (and its HTTP connection pool) across Streamlit reruns.
+
+    The connection pool is sized for the thread pool that generates the NPCs concurrently.
 
     Args:
         api_key (str): The API key for accessing the OpenAI API.
+
+    Returns:
+        OpenAI: The shared OpenAI client instance.
+    """
+    http_client = httpx.Client(limits=httpx.Limits(max_keepalive_connections=16, max_connections=32))  # Create an HTTP client with enough keep-alive connections for the NPC thread pool
+    return OpenAI(api_key=api_key, http_client=http_client)  # Create an OpenAI client instance with the provided API key
+
+client = get_openai_client(secret_key)  # Get the OpenAI client shared by every API call in the app
+
+def collect_tool_call_arguments(stream):
+    """
+    Accumulate the tool call arguments of a streamed OpenAI chat completion.
+
+    Args:
+        stream (Stream): The streamed chat completion chunks.
+
+    Returns:
+        str: The complete tool call arguments JSON string.
+    """
+    arguments = []  # Initialize an empty list to store the argument chunks
+    for chunk in stream:  # Loop through the streamed chunks as they arrive
+        if chunk.choices and chunk.choices[0].delta.tool_calls:  # If the chunk carries part of the tool call
+            arguments.append(chunk.choices[0].delta.tool_calls[0].function.arguments or "")  # Add the argument chunk to the list
+    return "".join(arguments)  # Join the argument chunks into the full JSON string
+
+def floyd_sample(pool, k):
+    """
+    Randomly select k distinct items from a list with Floyd's algorithm, which only draws k random numbers.
+
+    Args:
+        pool (list): The list to select from.
+        k (int): The number of items to select.
+
+    Returns:
+        list: The selected items.
+    """
+    selected = set()  # Initialize an empty set to store the selected indices
+    n = len(pool)  # Number of items to select from
+    for j in range(n - k, n):  # Loop through the last k indices
+        t = random.randrange(j + 1)  # Draw a random index up to and including j
+        selected.add(j if t in selected else t)  # Select the drawn index, or j if it was already selected
+    return [pool[i] for i in selected]  # Return the items at the selected indices
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def generate_lists(game_details):
+    """
+    Call the OpenAI API to generate lists of personas, occupations, and motivations based on the provided game details.
+
+    The result is cached on the game details, so resubmitting the same form skips the API call.
+
+    Args:
         game_details (dict): A dictionary containing the game details (setting, mood, feelings, storyboard).
 
     Returns:
@@ -93,25 +164,80 @@ def generate_lists(api_key, game_details):
                                         Additional notes: {game_details['storyboard']}
                                         Please provide diverse and unique lists for personas, occupations, and motivations based on these inputs."""}  # User message containing the game details
     ]
-    client = OpenAI(api_key=api_key)  # Create an OpenAI client instance with the provided API key
     response = client.chat.completions.create(
-        model="gpt-3.5-turbo-1106",  # Specify the GPT-3.5 model to use
+        model="gpt-4o-mini",  # Specify the GPT-4o mini model to use
         messages=messages,  # Pass the messages list to the API
         temperature=0,  # Set the temperature to 0 for deterministic output
-        functions=game_details['function_templates'],  # Pass the function templates to the API
-        function_call={"name": "npc_world_builder"},  # Specify the function to call (npc_world_builder)
+        seed=0,  # Fix the sampling seed, since a temperature of 0 alone does not make the output deterministic
+        max_tokens=2048,  # Cap the response length to bound the worst-case latency
+        tools=[{"type": "function", "function": function_template} for function_template in game_details['function_templates']],  # Pass the function templates to the API as tools
+        tool_choice={"type": "function", "function": {"name": "npc_world_builder"}},  # Specify the tool to call (npc_world_builder)
+        stream=True,  # Stream the response so the arguments are received while they are generated
     )  # Call the OpenAI API to generate the lists
-    json_string = response.choices[0].message.function_call.arguments  # Extract the function call arguments from the API response
-    dictionary = json.loads(json_string)  # Parse the JSON string into a dictionary
-    if len(dictionary["personas"]) > game_details['num_characteristics']:  # If the number of generated personas exceeds the desired number of characteristics
-        dictionary["personas"] = np.random.choice(dictionary["personas"], replace=False, size=game_details['num_characteristics']).tolist()  # Randomly select a subset of personas
-    if len(dictionary["occupations"]) > game_details['num_occupations']:  # If the number of generated occupations exceeds the desired number of occupations
-        dictionary["occupations"] = np.random.choice(dictionary["occupations"], replace=False, size=game_details['num_occupations']).tolist()  # Randomly select a subset of occupations
-    if len(dictionary["motivating_entities"]) > game_details['num_motivating_entities']:  # If the number of generated motivating entities exceeds the desired number of motivating entities
-        indices = np.random.choice(np.arange(len(dictionary["motivating_entities"])), replace=False, size=game_details['num_motivating_entities'])  # Randomly select indices for a subset of motivating entities
-        dictionary["motivating_entities"] = [dictionary["motivating_entities"][i] for i in indices]  # Select the motivating entities based on the randomly selected indices
+    json_string = collect_tool_call_arguments(response)  # Accumulate the tool call arguments from the streamed API response
+    dictionary = orjson.loads(json_string)  # Parse the JSON string into a dictionary
+    for list_name, size_key in (("personas", "num_characteristics"), ("occupations", "num_occupations"), ("motivating_entities", "num_motivating_entities")):  # Loop through each generated list and its desired size
+        if len(dictionary[list_name]) <= game_details[size_key]:  # If the model returned no more items than requested (the usual case at temperature 0)
+            continue  # Keep the list as is without sampling
+        if game_details[size_key] < len(dictionary[list_name]) / 4:  # If only a small part of the list is kept
+            dictionary[list_name] = floyd_sample(dictionary[list_name], game_details[size_key])  # Randomly select a subset of the list without touching the rest of it
+        else:  # If most of the list is kept
+            dictionary[list_name] = random.sample(dictionary[list_name], k=game_details[size_key])  # Randomly select a subset of the list
     return dictionary  # Return the dictionary containing the generated lists
 
+@st.cache_data(show_spinner=False, max_entries=256)
+def generate_character_details(game_details, character_i, persona, occupation, motivation, names, attempt, _api_key, _client):
+    """
+    Generate the character details of an NPC, memoized on the game details, its sampled traits, and the taken names so identical reruns reuse the same details.
+
+    Only the plain character details are cached, so every rerun and session builds its own NPC objects from them.
+
+    Args:
+        game_details (dict): A dictionary containing the game details (setting, mood, feelings, storyboard).
+        character_i (int): The index of the NPC within the generated world.
+        persona (str): The persona of the NPC.
+        occupation (str): The occupation of the NPC.
+        motivation (dict): A dictionary containing the motivating factor details (name, description).
+        names (tuple): The names of already defined NPCs the NPC must not reuse, or None.
+        attempt (int): The number of the attempt at a unique name, so each retry gets its own cache entry.
+        _api_key (str): The API key for accessing the OpenAI API (not part of the cache key).
+        _client (OpenAI): The shared OpenAI client (not part of the cache key).
+
+    Returns:
+        dict: A dictionary containing the generated character details.
+    """
+    npc_node = NPC(game_details, persona, occupation, motivation, _api_key, client=_client, generate_details=False)  # Create an NPC only to prompt for its character details
+    if names is None:
+        return npc_node.generate_character_details()  # Generate character details without considering other NPC names
+    return npc_node.generate_character_details(list(names))  # Generate character details considering other NPC names
+
+def build_npc(game_details, character_i, persona, occupation, motivation, api_key, client, names=None, attempt=0, name=None):
+    """
+    Create a fresh NPC from its (memoized) character details.
+
+    Args:
+        game_details (dict): A dictionary containing the game details (setting, mood, feelings, storyboard).
+        character_i (int): The index of the NPC within the generated world.
+        persona (str): The persona of the NPC.
+        occupation (str): The occupation of the NPC.
+        motivation (dict): A dictionary containing the motivating factor details (name, description).
+        api_key (str): The API key for accessing the OpenAI API.
+        client (OpenAI): The shared OpenAI client.
+        names (list, optional): A list of names of already defined NPCs. Defaults to None.
+        attempt (int, optional): The number of the attempt at a unique name. Defaults to 0.
+        name (str, optional): A name that replaces the generated one. Defaults to None.
+
+    Returns:
+        NPC: The created NPC.
+    """
+    names = tuple(names) if names is not None else None  # Freeze the taken names so they hash as part of the cache key
+    character_details = generate_character_details(game_details, character_i, persona, occupation, motivation, names, attempt, api_key, client)  # Get the (memoized) character details
+    if name is not None:  # If the caller overrides the generated name
+        character_details = {**character_details, "name": name}  # Replace the name without touching the cached details
+    npc_node = NPC(game_details, persona, occupation, motivation, api_key, client=client, generate_details=False)  # Create the NPC node without calling the OpenAI API
+    npc_node.set_character_details(character_details)  # Store the character details on the NPC node
+    return npc_node  # Return the NPC node
+
 def app():
     """
     The main Streamlit app function for configuring and generating NPCs.
@@ -137,39 +263,78 @@ def app():
         
         submitted = st.form_submit_button("Generate NPC Characteristics")  # Submit button to generate NPC characteristics
         if submitted:  # If the form is submitted
+            num_occupations = int(num_npcs * character_diversity / downscale_factor)  # Calculate the number of occupations based on the number of NPCs, character diversity, and downscale factor
+            num_characteristics = int(num_npcs * npc_diversity / downscale_factor)  # Calculate the number of characteristics based on the number of NPCs, NPC diversity, and downscale factor
+            num_motivating_entities = int(num_npcs * motivation_diversity / downscale_factor)  # Calculate the number of motivating entities based on the number of NPCs, motivation diversity, and downscale factor
             game_details = {
                 'setting': setting,  # Store the game setting in the game_details dictionary
                 'mood': mood,  # Store the game mood in the game_details dictionary
                 'feelings': feelings,  # Store the desired feelings in the game_details dictionary
                 'storyboard': storyboard,  # Store the storyboard details in the game_details dictionary
-                'num_occupations': int(num_npcs * character_diversity / downscale_factor),  # Calculate the number of occupations based on the number of NPCs, character diversity, and downscale factor
-                'num_characteristics': int(num_npcs * npc_diversity / downscale_factor),  # Calculate the number of characteristics based on the number of NPCs, NPC diversity, and downscale factor
-                'num_motivating_entities': int(num_npcs * motivation_diversity / downscale_factor),  # Calculate the number of motivating entities based on the number of NPCs, motivation diversity, and downscale factor
-                'function_templates': create_custom_function_template(int(num_npcs * character_diversity / downscale_factor), int(num_npcs * npc_diversity / downscale_factor), int(num_npcs * motivation_diversity / downscale_factor))  # Create custom function templates based on the calculated values
+                'num_occupations': num_occupations,  # Store the number of occupations in the game_details dictionary
+                'num_characteristics': num_characteristics,  # Store the number of characteristics in the game_details dictionary
+                'num_motivating_entities': num_motivating_entities,  # Store the number of motivating entities in the game_details dictionary
+                'function_templates': create_custom_function_template(num_characteristics, num_occupations, num_motivating_entities)  # Get the (memoized) custom function templates for the calculated values
             }
             api_key = secret_key  # Set the API key to the secret key
-            result = generate_lists(api_key, game_details)  # Generate lists of personas, occupations, and motivations using the OpenAI API
-            name_list = []  # Initialize an empty list to store NPC names
-            npc_nodes = []  # Initialize an empty list to store NPC nodes
+            with st.spinner("Generating personas, occupations, and motivations"):  # Show a spinner while the lists stream in, since partial JSON is not displayable
+                result = generate_lists(game_details)  # Generate lists of personas, occupations, and motivations using the OpenAI API
+            personas = result["personas"]  # Bind the generated personas list once
+            occupations = result["occupations"]  # Bind the generated occupations list once
+            motivations = result["motivating_entities"]  # Bind the generated motivating entities list once
+            form_inputs = sorted((key, value) for key, value in game_details.items() if key != 'function_templates')  # The form inputs (the function templates are derived from them)
+            seed = int.from_bytes(hashlib.blake2b(repr((form_inputs, num_npcs)).encode(), digest_size=8).digest(), 'little')  # Derive a seed from the form inputs so identical submissions sample identical traits
+            rng = random.Random(seed)  # Create a random generator seeded from the form inputs
+            triples = list(zip(  # Pre-sample the traits of every NPC up front so the random draws stay on the main thread
+                rng.choices(personas, k=num_npcs),  # Randomly select a persona for every NPC in a single draw
+                rng.choices(occupations, k=num_npcs),  # Randomly select an occupation for every NPC in a single draw
+                rng.choices(motivations, k=num_npcs),  # Randomly select a motivating entity for every NPC in a single draw
+            ))  # Combine the draws into one (persona, occupation, motivation) triple per NPC
+            npc_nodes = [None] * num_npcs  # Preallocate the NPC node list so nodes keep their sampling order
             my_bar = st.progress(0.0, text="Generating characters")  # Create a progress bar for character generation
-            for character_i in range(num_npcs):  # Loop through the number of NPCs to generate
-                selected_persona = np.random.choice(result["personas"])  # Randomly select a persona from the generated personas list
-                selected_occupation = np.random.choice(result["occupations"])  # Randomly select an occupation from the generated occupations list
-                selected_motivation = result["motivating_entities"][int(np.random.choice(np.arange(len(result["motivating_entities"]))))]  # Randomly select a motivating entity from the generated motivating entities list
-                if len(name_list) == 0:  # If the name list is empty (first NPC)
-                    npc_node = NPC(game_details, selected_persona, selected_occupation, selected_motivation, api_key)  # Create an NPC node without a name list
-                else:  # If the name list is not empty (subsequent NPCs)
-                    npc_node = NPC(game_details, selected_persona, selected_occupation, selected_motivation, api_key, name_list)  # Create an NPC node with the name list
-                st.write(npc_node.name, npc_node.tldr, npc_node.character_sheet)  # Display the NPC name, TLDR, and character sheet in the Streamlit app
+            update_every = max(1, num_npcs // 10)  # Limit the progress bar to roughly ten updates regardless of the number of NPCs
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(num_npcs, 8)) as executor:  # Create the NPCs concurrently since each one blocks on an OpenAI call
+                futures = {
+                    executor.submit(build_npc, game_details, character_i, selected_persona, selected_occupation, selected_motivation, api_key, client): character_i
+                    for character_i, (selected_persona, selected_occupation, selected_motivation) in enumerate(triples)
+                }  # Map each pending NPC to its index
+                for completed, future in enumerate(concurrent.futures.as_completed(futures), start=1):  # Handle the NPCs as soon as they are ready
+                    npc_node = future.result()  # Get the created NPC node (re-raises any API error)
+                    npc_nodes[futures[future]] = npc_node  # Store the NPC node at its original index
+                    st.write(npc_node.name, npc_node.tldr, npc_node.character_sheet)  # Display the NPC name, TLDR, and character sheet in the Streamlit app
+                    if completed % update_every == 0 or completed == num_npcs:  # Only update the progress bar on every update_every-th NPC and the last one
+                        my_bar.progress(completed / num_npcs, text="Generating characters")  # Update the progress bar with the current character generation progress
+
+            name_list = []  # Initialize an empty list to store the unique NPC names
+            for character_i, npc_node in enumerate(npc_nodes):  # Loop through the generated NPC nodes to enforce unique names
+                persona, occupation, motivation = triples[character_i]  # Reuse the traits sampled for this NPC
+                attempt = 0  # Count the regenerations of this NPC
+                while npc_node.name in name_list and attempt < max_name_retries:  # While another NPC already took this name and retries are left
+                    attempt += 1  # Count the regeneration
+                    npc_node = build_npc(game_details, character_i, persona, occupation, motivation, api_key, client, name_list, attempt)  # Regenerate the NPC with the taken names through the same cache
+                if npc_node.name in name_list:  # If the model kept returning taken names
+                    suffix = 2  # Start numbering from the second NPC with this name
+                    while f"{npc_node.name} {suffix}" in name_list:  # Find the first free numbered name
+                        suffix += 1
+                    npc_node = build_npc(game_details, character_i, persona, occupation, motivation, api_key, client, name_list, attempt, f"{npc_node.name} {suffix}")  # Make the name unique with a suffix
+                if npc_node is not npc_nodes[character_i]:  # If the NPC was regenerated or renamed
+                    npc_nodes[character_i] = npc_node  # Replace the duplicate NPC node
+                    st.write(npc_node.name, npc_node.tldr, npc_node.character_sheet)  # Display the regenerated NPC in the Streamlit app
                 name_list.append(npc_node.name)  # Add the NPC name to the name list
-                npc_nodes.append(npc_node)  # Add the NPC node to the npc_nodes list
-                for npc_node_idx in range(len(npc_nodes) - 1):  # Loop through the previously generated NPC nodes
-                    npc_node.set_relation(npc_nodes[npc_node_idx])  # Set the relationship between the current NPC and the previous NPC
-                    npc_nodes[npc_node_idx].set_relation(npc_node, json.dumps(npc_node.relations))  # Set the relationship between the previous NPC and the current NPC
-                my_bar.progress((character_i + 1) / num_npcs, text="Generating character: " + npc_node.name)  # Update the progress bar with the current character generation progress
-
-            for character_i in range(num_npcs):  # Loop through the generated NPCs
-                node = npc_nodes[character_i].export_npc("./characters")  # Export the NPC data to the "./characters" directory
+
+            with st.spinner("Generating relationships"), concurrent.futures.ThreadPoolExecutor(max_workers=min(num_npcs, 8)) as executor:  # Set every NPC's relationships concurrently, one API call per NPC
+                list(executor.map(lambda npc_node: npc_node.set_relations([other_node for other_node in npc_nodes if other_node is not npc_node]), npc_nodes))  # Relate each NPC to all the others (re-raises any API error)
+
+            file_stems = []  # Initialize an empty list to store one distinct file name per NPC
+            for npc_node in npc_nodes:  # Loop through the NPC nodes to keep NPCs whose names clean to the same string from writing the same file at once
+                file_stem = base_stem = npc_node.export_file_stem()  # Start from the file name derived from the NPC's name
+                suffix = 2  # Start numbering from the second NPC with this file name
+                while file_stem in file_stems:  # While another NPC already writes to this file
+                    file_stem = f"{base_stem}_{suffix}"  # Number the file name
+                    suffix += 1
+                file_stems.append(file_stem)  # Reserve the file name
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:  # Export the NPCs concurrently to overlap the file writes
+                list(executor.map(lambda npc_node, file_stem: npc_node.export_npc("./characters", file_stem), npc_nodes, file_stems))  # Export the NPC data to the "./characters" directory (re-raises any I/O error)
 
 if __name__ == "__main__":
     app()  # Run the Streamlit app
\ No newline at end of file
@@ -1,19 +1,138 @@
+import asyncio  # Import the asyncio library for generating NPCs concurrently
+from collections import deque  # Import deque for the sliding window of recent messages
+from concurrent.futures import ThreadPoolExecutor  # Import ThreadPoolExecutor for summarizing memories in the background
 import json  # Import the json library for parsing and creating JSON data
-from openai import OpenAI  # Import the OpenAI library for accessing the GPT-3 API
+from functools import lru_cache  # Import lru_cache for sharing one OpenAI client per API key
+import jiter  # Import the jiter library for parsing partial JSON while it streams in
+import orjson  # Import the orjson library for parsing the structured outputs and writing the exported JSON files
 import os  # Import the os library for file and directory operations
-import numpy as np  # Import the numpy library for numerical operations
+from pathlib import Path  # Import Path for writing the exported JSON files
+import random  # Import the random library for picking the first letter of NPC names
 import re  # Import the re library for regular expression operations
+import string  # Import the string library for the alphabet
+import threading  # Import the threading library for guarding the memory against the background summaries
+
+_ALPHA = string.ascii_lowercase  # Letters an NPC name can start with
+_UNSAFE_NAME_CHARACTERS = re.compile('[^a-zA-Z]')  # Characters replaced with underscores in exported file names
+_summary_executor = ThreadPoolExecutor(max_workers=4)  # Background workers that summarize NPC memories off the caller's thread
+
+@lru_cache(maxsize=8)
+def get_client(api_key):
+    """
+    Get the OpenAI client for an API key, creating it on first use so every NPC shares its HTTP connection pool.
+
+    Args:
+        api_key (str): The API key for accessing the OpenAI API.
+
+    Returns:
+        OpenAI: The shared OpenAI client instance.
+    """
+    import httpx  # Import httpx and openai on first use so importing npc stays fast for code that only exports NPCs
+    from openai import OpenAI
+
+    http_client = httpx.Client(limits=httpx.Limits(max_keepalive_connections=32))  # Create an HTTP client that keeps connections alive between requests
+    return OpenAI(api_key=api_key, http_client=http_client)  # Create an OpenAI client instance with the provided API key
+
+def parse_structured_output(json_string):
+    """
+    Parse the structured JSON output returned by the OpenAI API.
+
+    Args:
+        json_string (str | bytes | bytearray): The structured output JSON.
+
+    Returns:
+        dict: The parsed output.
+    """
+    return orjson.loads(json_string)  # Parse the JSON as-is, without re-encoding str to bytes (orjson also caches the repeated keys)
+
+def raw_structured_output(raw_response):
+    """
+    Extract the structured JSON output from a raw chat completion response.
+
+    Args:
+        raw_response (LegacyAPIResponse): The response of a chat.completions.with_raw_response.create call.
+
+    Returns:
+        str: The structured output JSON.
+
+    Raises:
+        ValueError: If the model refused to answer.
+    """
+    message = raw_message(raw_response)  # Extract the message of the first choice
+    if message.get("refusal"):  # If the model refused to produce the structured output
+        raise ValueError(f"The model refused to answer: {message['refusal']}")
+    return message["content"]  # Return the structured output JSON
+
+def raw_message(raw_response):
+    """
+    Extract the first message of a raw chat completion response, skipping the SDK's response model validation.
+
+    Args:
+        raw_response (LegacyAPIResponse): The response of a chat.completions.with_raw_response.create call.
+
+    Returns:
+        dict: The message of the first choice.
+    """
+    body = jiter.from_json(raw_response.content, cache_mode="keys")  # Parse the response body bytes directly
+    return body["choices"][0]["message"]  # Return the message of the first choice
+
+def collect_structured_output(stream):
+    """
+    Collect the structured JSON output of a streamed OpenAI chat completion without parsing it.
+
+    Args:
+        stream (Iterable): The streamed chat completion chunks.
+
+    Yields:
+        str: Each content chunk of the output as it arrives.
+
+    Raises:
+        ValueError: If the model refused to answer.
+    """
+    refusal = []  # Initialize an empty list to store the refusal chunks
+    for chunk in stream:  # Loop through the streamed chunks as they arrive
+        if not chunk.choices:  # If the chunk does not carry a choice
+            continue  # Skip the chunk
+        delta = chunk.choices[0].delta  # Take the delta of the first choice
+        if getattr(delta, "refusal", None):  # If the model is refusing to produce the structured output
+            refusal.append(delta.refusal)  # Add the refusal chunk to the list
+        if delta.content:  # If the chunk carries part of the output
+            yield delta.content  # Publish the content chunk
+    if refusal:  # If the model refused to produce the structured output
+        raise ValueError(f"The model refused to answer: {''.join(refusal)}")
+
+def stream_structured_output(stream, name, client):
+    """
+    Parse the structured JSON output of a streamed OpenAI chat completion as it arrives.
+
+    Each chunk re-parses the whole output so far, so only use this when the partial fields are needed; otherwise request a non-streamed completion.
+
+    Args:
+        stream (Stream): The streamed chat completion chunks.
+        name (str): The name of the template the output should match.
+        client (OpenAI): The OpenAI client used to repair a malformed output.
+
+    Yields:
+        dict: The output parsed so far after each chunk (incomplete strings are included as-is),
+            followed by the strictly parsed and validated complete output once the stream ends.
+
+    Raises:
+        ValueError: If the model refused to answer.
+    """
+    buffer = bytearray()  # Initialize an empty buffer to store the content chunks
+    for content in collect_structured_output(stream):  # Loop through the content chunks as they arrive
+        buffer += content.encode()  # Add the content chunk to the buffer
+        try:
+            yield jiter.from_json(bytes(buffer), partial_mode="trailing-strings")  # Publish the fields parsed so far
+        except ValueError:  # If the buffer ends in the middle of a token that cannot be parsed yet
+            continue  # Wait for the next chunk
+    yield load_structured_output(buffer, name, client)  # Publish the complete output, repairing it if it is truncated or invalid
 
 function_templates = [
     {
         "name": "npc_character_sheet",  # Name of the function template for generating character details
-        "description": """Generate character details for an NPC based on the provided persona, occupation, and motivating factor. 
-                            Please provide the following details:
-                            1. Name of the character
-                            2. One-line TLDR of the character
-                            3. One-line explanation of speech patterns and how the character speaks
-                            4. One sentence about the character's motivations/life
-                            5. Character sheet with properties: kindness, intelligence, strength, cunning, wisdom, charisma, dexterity, constitution, empathy, loyalty""",  # Description of the function template
+        # The name, TLDR, speech pattern, motivation, and character sheet fields describe themselves
+        "description": "Generate an NPC character sheet from a persona, occupation, and motivation.",  # Description of the function template
         "parameters": {  # Parameters of the function template
             "type": "object",  # Type of the parameters (object)
             "properties": {  # Properties of the parameters
@@ -59,17 +178,14 @@ function_templates = [
                     "enum": ["compassionate", "caring", "neutral", "indifferent", "cold", "cruel"]  # Enumerated values for the kindness property
                 },
             },
-            "required": ["name", "TLDR", "speech_pattern", "character_motivation", "intellect", "charisma", "integrity", "resilience", "kindness"]  # Required properties for the character details
+            "required": ["name", "TLDR", "speech_pattern", "character_motivation", "intellect", "charisma", "integrity", "resilience", "kindness"],  # Required properties for the character details
+            "additionalProperties": False  # Disallow other properties (required for strict structured outputs)
         }
     },
     {
         "name": "npc_relationship_sheet",  # Name of the function template for generating relationship details
-        "description": """Analyze the provided character sheets and determine the relationship between the two NPCs.
-                            Please provide the following details:
-                            1. Relationship Type: The nature of the relationship between the two NPCs.
-                            2. Relationship Dynamic: The power dynamic or balance in the relationship.
-                            3. Relationship Strength: The intensity or depth of the relationship.
-                            4. Relationship Keywords: 2-3 keywords that best describe the relationship.""",  # Description of the function template
+        # The relationship type, dynamic, strength, keywords, and TLDR fields describe themselves
+        "description": "Determine the relationship between two NPCs from NPC 1's perspective.",  # Description of the function template
         "parameters": {  # Parameters of the function template
             "type": "object",  # Type of the parameters (object)
             "properties": {  # Properties of the parameters
@@ -102,15 +218,218 @@ function_templates = [
                     "description": "Describe in one sentence and less than 5 words how the tldr works. This should be like mother, follows me, i'm the leader, part of friend group, student in class, etc."  # Description of the tldr property
                 }
             },
-            "required": ["relationship_type", "relationship_dynamic", "relationship_strength", "relationship_keywords", "tldr"]  # Required properties for the relationship details
+            "required": ["relationship_type", "relationship_dynamic", "relationship_strength", "relationship_keywords", "tldr"],  # Required properties for the relationship details
+            "additionalProperties": False  # Disallow other properties (required for strict structured outputs)
         }
     }
 ]
 
+function_templates.append({
+    "name": "npc_relationship_matrix",  # Name of the function template for generating the relationships to several NPCs at once
+    "description": "Determine NPC 1's relationship to each other NPC, one entry per NPC.",  # Description of the function template
+    "parameters": {  # Parameters of the function template
+        "type": "object",  # Type of the parameters (object)
+        "properties": {  # Properties of the parameters
+            "relations": {  # Property for the list of relationships
+                "type": "array",  # Type of the relations property (array)
+                "description": "One relationship entry for every other NPC.",  # Description of the relations property
+                "items": {  # Items within the relations array
+                    "type": "object",  # Type of each item in the relations array (object)
+                    "properties": {  # Properties of each relationship entry
+                        "target_name": {  # Property for the name of the other NPC
+                            "type": "string",  # Type of the target_name property (string)
+                            "description": "Exact name of the other NPC this relationship is about."  # Description of the target_name property
+                        },
+                        **function_templates[1]["parameters"]["properties"]  # Reuse the properties of the single relationship sheet
+                    },
+                    "required": ["target_name"] + function_templates[1]["parameters"]["required"],  # Required properties for each relationship entry
+                    "additionalProperties": False  # Disallow other properties (required for strict structured outputs)
+                }
+            }
+        },
+        "required": ["relations"],  # Required properties for the relationship details
+        "additionalProperties": False  # Disallow other properties (required for strict structured outputs)
+    }
+})  # Add the batched relationship template, built from the single relationship sheet so both stay in sync
+
+function_templates.append({
+    "name": "npc_character_sheet_batch",  # Name of the function template for generating the character details of several NPCs at once
+    "description": "Generate one NPC character sheet per listed NPC, in the same order.",  # Description of the function template
+    "parameters": {  # Parameters of the function template
+        "type": "object",  # Type of the parameters (object)
+        "properties": {  # Properties of the parameters
+            "characters": {  # Property for the list of character sheets
+                "type": "array",  # Type of the characters property (array)
+                "description": "One character sheet for every listed NPC, in the same order.",  # Description of the characters property
+                "items": function_templates[0]["parameters"]  # Reuse the single character sheet as the item schema
+            }
+        },
+        "required": ["characters"],  # Required properties for the character details
+        "additionalProperties": False  # Disallow other properties (required for strict structured outputs)
+    }
+})  # Add the batched character sheet template, built from the single character sheet so both stay in sync
+
+structured_outputs = {
+    function_template["name"]: {
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": function_template["name"],
+                "description": function_template["description"],
+                "schema": function_template["parameters"],
+                "strict": True,  # Let the server constrain decoding to the schema so the output is always valid JSON
+            },
+        },
+    }
+    for function_template in function_templates
+}  # Build the structured output request parameters of each template once (passed as extra_body, so the SDK does not re-walk the schema on every call)
+
+def validate_structured_output(output, schema, path="output"):
+    """
+    Check that a parsed structured output has every required field of its schema.
+
+    Args:
+        output: The parsed structured output (or a part of it).
+        schema (dict): The JSON schema the output should match.
+        path (str, optional): Where the output sits within the full output, for error messages. Defaults to "output".
+
+    Returns:
+        The validated output.
+
+    Raises:
+        ValueError: If the output does not match the schema.
+    """
+    if schema.get("type") == "object":  # If the schema describes an object
+        if not isinstance(output, dict):
+            raise ValueError(f"{path} is not an object")
+        missing = [key for key in schema.get("required", ()) if key not in output]  # Required fields the output lacks
+        if missing:
+            raise ValueError(f"{path} is missing {missing}")
+        for key, property_schema in schema.get("properties", {}).items():  # Loop through the properties of the object
+            if key in output:  # Skip optional properties the output leaves out
+                validate_structured_output(output[key], property_schema, f"{path}.{key}")  # Validate the property
+    elif schema.get("type") == "array":  # If the schema describes an array
+        if not isinstance(output, list):
+            raise ValueError(f"{path} is not an array")
+        for item_i, item in enumerate(output):  # Loop through the items of the array
+            validate_structured_output(item, schema["items"], f"{path}[{item_i}]")  # Validate the item
+    return output  # Return the validated output
+
+def structured_output_schema(json_string, name):
+    """
+    Look up the schema a structured output should match, refusing outputs that are missing altogether.
+
+    Args:
+        json_string (str | bytes | bytearray | None): The structured output JSON, or None if the model returned no content.
+        name (str): The name of the template the output should match.
+
+    Returns:
+        dict: The JSON schema of the template.
+
+    Raises:
+        ValueError: If there is no output.
+    """
+    if not json_string:  # If the model returned no output at all
+        raise ValueError(f"The model returned no {name} output")  # Nothing to repair, so do not let the repair request make one up
+    return structured_outputs[name]["response_format"]["json_schema"]["schema"]  # The schema the output should match
+
+def check_structured_output(json_string, schema):
+    """
+    Parse a structured output and validate it against its schema.
+
+    Args:
+        json_string (str | bytes | bytearray): The structured output JSON.
+        schema (dict): The JSON schema the output should match.
+
+    Returns:
+        dict: The parsed output.
+
+    Raises:
+        ValueError: If the output is not valid JSON or does not match the schema.
+    """
+    return validate_structured_output(parse_structured_output(json_string), schema)  # Parse and validate the output
+
+def repair_request(json_string, name, error):
+    """
+    Build the OpenAI API request parameters for repairing a structured output that failed to parse or validate.
+
+    Args:
+        json_string (str | bytes | bytearray): The malformed structured output JSON.
+        name (str): The name of the template the output should match.
+        error (ValueError): The parsing or validation error.
+
+    Returns:
+        dict: The keyword arguments for chat.completions.with_raw_response.create.
+    """
+    if not isinstance(json_string, str):  # If the JSON is still raw bytes
+        json_string = bytes(json_string).decode(errors="replace")  # Decode it for the prompt
+    return {
+        "model": "gpt-4o-mini",  # Specify the GPT-4o mini model to use (structured outputs need it)
+        "messages": [
+            {"role": "system", "content": "Fix the provided JSON so it is valid and matches the schema. Keep every existing value."},  # System message to set the context for the API request
+            {"role": "user", "content": f"Error: {error}\nJSON:\n{json_string}"}  # User message containing the error and the malformed JSON
+        ],
+        "temperature": 0,  # Set the temperature to 0 for a faithful repair
+        "max_tokens": 256 + len(json_string) // 3,  # Leave just enough room to echo the output back
+        "extra_body": structured_outputs[name],  # Request a structured output matching the same schema
+    }
+
+def load_structured_output(json_string, name, client):
+    """
+    Parse and validate a structured output, repairing it once with a small completion if it is malformed.
+
+    Fixing a truncated or invalid output costs far fewer tokens than generating it again from scratch.
+
+    Args:
+        json_string (str | bytes | bytearray | None): The structured output JSON, or None if the model returned no content.
+        name (str): The name of the template the output should match.
+        client (OpenAI): The OpenAI client used for the repair request.
+
+    Returns:
+        dict: The parsed output.
+
+    Raises:
+        ValueError: If there is no output, or the repaired output still does not match the schema.
+    """
+    schema = structured_output_schema(json_string, name)  # Look up the schema the output should match
+    try:
+        return check_structured_output(json_string, schema)  # Parse and validate the output
+    except ValueError as error:  # If the output is malformed
+        response = client.chat.completions.with_raw_response.create(**repair_request(json_string, name, error))  # Call the OpenAI API to repair the output
+        return check_structured_output(raw_structured_output(response), schema)  # Parse and validate the repaired output
+
+async def aload_structured_output(json_string, name, async_client):
+    """
+    Asynchronously parse and validate a structured output, repairing it once with a small completion if it is malformed.
+
+    Args:
+        json_string (str | bytes | bytearray | None): The structured output JSON, or None if the model returned no content.
+        name (str): The name of the template the output should match.
+        async_client (AsyncOpenAI): The async OpenAI client used for the repair request.
+
+    Returns:
+        dict: The parsed output.
+
+    Raises:
+        ValueError: If there is no output, or the repaired output still does not match the schema.
+    """
+    schema = structured_output_schema(json_string, name)  # Look up the schema the output should match
+    try:
+        return check_structured_output(json_string, schema)  # Parse and validate the output
+    except ValueError as error:  # If the output is malformed
+        response = await async_client.chat.completions.with_raw_response.create(**repair_request(json_string, name, error))  # Call the OpenAI API to repair the output
+        return check_structured_output(raw_structured_output(response), schema)  # Parse and validate the repaired output
+
 class NPC:
-    def __init__(self, game_details, persona, occupation, motivating_factor, api_key, names=None):
+    __slots__ = (
+        "api_key", "client", "game_details", "persona", "occupation", "motivating_factor",
+        "short_term", "long_term_summary", "_evicted", "_memory_lock", "_summarize_future", "relations",
+        "name", "tldr", "speech_pattern", "motivation", "character_sheet", "_character_sheet_json", "_relation_block", "_prompt_prefix"
+    )  # Store the attributes in fixed slots instead of a per-instance dictionary, since worlds can hold hundreds of NPCs
+
+    def __init__(self, game_details, persona, occupation, motivating_factor, api_key, names=None, client=None, generate_details=True):
         """
-        Initialize an NPC object with the provided game details, persona, occupation, motivating factor, API key, and optional names.
+        Initialize an NPC object with the provided game details, persona, occupation, motivating factor, API key, and optional names and client.
 
         Args:
             game_details (dict): A dictionary containing the game details (setting, mood, feelings, storyboard).
@@ -119,20 +438,125 @@ class NPC:
             motivating_factor (dict): A dictionary containing the motivating factor details (name, description).
             api_key (str): The API key for accessing the OpenAI API.
             names (list, optional): A list of names of already defined NPCs. Defaults to None.
+            client (OpenAI, optional): A shared OpenAI client to reuse its connection pool. Defaults to the cached client for the API key.
+            generate_details (bool, optional): Whether to generate the character details right away. Defaults to True.
+                When False, the caller must pass the details to set_character_details before using the NPC.
         """
         self.api_key = api_key  # Store the API key
+        self.client = client if client is not None else get_client(api_key)  # Store the OpenAI client used for every API call of this NPC
         self.game_details = game_details  # Store the game details
         self.persona = persona  # Store the NPC's persona
         self.occupation = occupation  # Store the NPC's occupation
         self.motivating_factor = motivating_factor  # Store the NPC's motivating factor
-        self.memory = []  # Initialize an empty list to store the NPC's memory
+        self._prompt_prefix = self.format_prompt_prefix()  # Format the game details and NPC characteristics once for every character details prompt
+        self.short_term = deque(maxlen=8)  # Initialize the sliding window of the 8 most recent raw messages
+        self.long_term_summary = ""  # Initialize the running summary of the messages that left the window
+        self._evicted = []  # Messages that left the window but are not yet folded into the summary
+        self._memory_lock = threading.Lock()  # Guard the memory while it is summarized in the background
+        self._summarize_future = None  # The pending background summarization, if any
         self.relations = {}  # Initialize an empty dictionary to store the NPC's relationships
 
         # Generate character sheet, name, and other properties
+        if not generate_details:  # If the caller provides the character details itself
+            return  # Leave the character details unset
         if names is None:
             character_details = self.generate_character_details()  # Generate character details without considering other NPC names
         else:
             character_details = self.generate_character_details(names)  # Generate character details considering other NPC names
+        self.set_character_details(character_details)  # Store the generated character details
+
+    @classmethod
+    async def acreate(cls, game_details, persona, occupation, motivating_factor, api_key, async_client, names=None, client=None):
+        """
+        Asynchronously create an NPC, generating its character details with the provided async OpenAI client.
+
+        Args:
+            game_details (dict): A dictionary containing the game details (setting, mood, feelings, storyboard).
+            persona (str): The persona of the NPC.
+            occupation (str): The occupation of the NPC.
+            motivating_factor (dict): A dictionary containing the motivating factor details (name, description).
+            api_key (str): The API key for accessing the OpenAI API.
+            async_client (AsyncOpenAI): The async OpenAI client used to generate the character details.
+            names (list, optional): A list of names of already defined NPCs. Defaults to None.
+            client (OpenAI, optional): A shared OpenAI client for the NPC's later synchronous calls. Defaults to the cached client for the API key.
+
+        Returns:
+            NPC: The created NPC.
+        """
+        npc = cls(game_details, persona, occupation, motivating_factor, api_key, client=client, generate_details=False)  # Create the NPC without generating its character details
+        npc.set_character_details(await npc.agenerate_character_details(async_client, names))  # Generate and store the character details
+        return npc  # Return the created NPC
+
+    @classmethod
+    def generate_batch(cls, game_details, traits, api_key, batch_size=5, names=None, client=None):
+        """
+        Create several NPCs, generating the character details of up to batch_size NPCs with a single OpenAI API call.
+
+        The game details are sent once per batch instead of once per NPC. Any NPC missing from a response falls back to its own generate_character_details call.
+
+        Args:
+            game_details (dict): A dictionary containing the game details (setting, mood, feelings, storyboard).
+            traits (list): A list of (persona, occupation, motivating_factor) tuples, one per NPC.
+            api_key (str): The API key for accessing the OpenAI API.
+            batch_size (int, optional): The number of NPCs generated per API call. Defaults to 5.
+            names (list, optional): A list of names of already defined NPCs. Defaults to None.
+            client (OpenAI, optional): A shared OpenAI client to reuse its connection pool. Defaults to the cached client for the API key.
+
+        Returns:
+            list: The created NPC objects, in the order of the traits.
+        """
+        client = client if client is not None else get_client(api_key)  # Get the OpenAI client shared by the whole batch
+        taken_names = list(names) if names is not None else []  # Names the new NPCs should avoid
+        npcs = []  # Initialize an empty list to store the created NPCs
+        for start in range(0, len(traits), batch_size):  # Loop through the traits one batch at a time
+            batch = [cls(game_details, persona, occupation, motivating_factor, api_key, client=client, generate_details=False) for persona, occupation, motivating_factor in traits[start:start + batch_size]]  # Create the NPCs of this batch without generating their character details
+            npc_list = "\n".join(
+                f"""NPC {npc_i + 1}:
+                                            Persona: {npc.persona}
+                                            Occupation: {npc.occupation}
+                                            Motivating Factor: {npc.motivating_factor['motivating_name']} - {npc.motivating_factor['motivating_description']}
+                                            Find a name starting with {random.choice(_ALPHA)}"""
+                for npc_i, npc in enumerate(batch)
+            )  # Per-NPC section of the prompt
+            messages = [
+                {"role": "system", "content": "Generate character details for several NPCs based on the provided personas, occupations, and motivating factors."},  # System message to set the context for the API request
+                {"role": "user", "content": f"""The game is about: 
+                                            Game setting description: {game_details['setting']}
+                                            Game mood: {game_details['mood']}
+                                            Desired feelings: {game_details['feelings']}
+                                            Additional notes: {game_details['storyboard']}
+
+                                            Create exactly {len(batch)} NPCs with unique names, in this order:
+                                            {npc_list}
+
+                                            Some names of already defined npcs include: {taken_names} (find unique names)
+                                            """}  # User message containing the game details once and the characteristics of every NPC in the batch
+            ]
+            response = client.chat.completions.with_raw_response.create(
+                model="gpt-4o-mini",  # Specify the GPT-4o mini model to use (structured outputs need it)
+                messages=messages,  # Pass the messages list to the API
+                temperature=0.7,  # Set the temperature for generating diverse character details
+                extra_body=structured_outputs["npc_character_sheet_batch"],  # Request a structured output matching the npc_character_sheet_batch schema
+            )  # Call the OpenAI API to generate the character details of the whole batch
+            json_string = raw_structured_output(response)  # Extract the structured output from the raw API response
+            characters = load_structured_output(json_string, "npc_character_sheet_batch", client)["characters"]  # Parse the JSON string and take the list of character sheets
+            for npc, character_details in zip(batch, characters):  # Loop through the NPCs and their generated character details
+                npc.set_character_details(character_details)  # Store the character details on the NPC
+            batch_names = [npc.name for npc in batch[:len(characters)]]  # Names generated for this batch so far
+            for npc in batch[len(characters):]:  # Loop through the NPCs the response skipped
+                npc.set_character_details(npc.generate_character_details(taken_names + batch_names))  # Fall back to a single character details call
+                batch_names.append(npc.name)  # Add the NPC's name to the batch's names
+            taken_names.extend(batch_names)  # Add the batch's names to the taken names
+            npcs.extend(batch)  # Add the batch to the created NPCs
+        return npcs  # Return the created NPCs
+
+    def set_character_details(self, character_details):
+        """
+        Store the generated character details on the NPC.
+
+        Args:
+            character_details (dict): A dictionary containing the generated character details.
+        """
         self.name = character_details['name']  # Store the NPC's name
         self.tldr = character_details['TLDR']  # Store the NPC's TLDR
         self.speech_pattern = character_details['speech_pattern']  # Store the NPC's speech pattern
@@ -144,21 +568,23 @@ class NPC:
             "resilience": character_details["resilience"],
             "kindness": character_details["kindness"]
         }
+        self._character_sheet_json = json.dumps(self.character_sheet, separators=(",", ":"))  # Serialize the character sheet once for the relationship prompts
+        self._relation_block = (
+            f"Name: {self.name}\n"
+            f"TLDR: {self.tldr}\n"
+            f"Speech Pattern: {self.speech_pattern}\n"
+            f"Motivation: {self.motivation}\n"
+            f"Character Sheet: {self._character_sheet_json}"
+        )  # Format the NPC's part of the relationship prompts once instead of once per pair
 
-    def generate_character_details(self, other_names=None):
+    def format_prompt_prefix(self):
         """
-        Generate character details for the NPC using the OpenAI API.
-
-        Args:
-            other_names (list, optional): A list of names of already defined NPCs. Defaults to None.
+        Format the part of the character details prompt that only depends on the game details and the NPC's characteristics.
 
         Returns:
-            dict: A dictionary containing the generated character details.
+            str: The formatted game details and NPC characteristics.
         """
-        if other_names is None:
-            messages = [
-                {"role": "system", "content": "Generate character details for an NPC based on the provided persona, occupation, and motivating factor."},  # System message to set the context for the API request
-                {"role": "user", "content": f"""The game is about: 
+        return f"""The game is about: 
                                             Game setting description: {self.game_details['setting']}
                                             Game mood: {self.game_details['mood']}
                                             Desired feelings: {self.game_details['feelings']}
@@ -168,67 +594,176 @@ class NPC:
                                             Persona: {self.persona}
                                             Occupation: {self.occupation}
                                             Motivating Factor: {self.motivating_factor['motivating_name']} - {self.motivating_factor['motivating_description']}
+"""  # Format the game details and NPC characteristics
 
-                                            Find a name starting with {str(np.random.choice([i for i in "abcdefghijklmnopqrstuvwxyz"]))}
-                                            """}  # User message containing the game details, NPC characteristics, and a random starting letter for the name
-            ]
-        else:
-            messages = [
-                {"role": "system", "content": "Generate character details for an NPC based on the provided persona, occupation, and motivating factor."},  # System message to set the context for the API request
-                {"role": "user", "content": f"""The game is about: 
-                                            Game setting description: {self.game_details['setting']}
-                                            Game mood: {self.game_details['mood']}
-                                            Desired feelings: {self.game_details['feelings']}
-                                            Additional notes: {self.game_details['storyboard']}
+    def character_details_messages(self, other_names=None):
+        """
+        Build the chat messages for generating the NPC's character details.
 
-                                            This NPC within the game needs to be about:
-                                            Persona: {self.persona}
-                                            Occupation: {self.occupation}
-                                            Motivating Factor: {self.motivating_factor['motivating_name']} - {self.motivating_factor['motivating_description']}
+        Args:
+            other_names (list, optional): A list of names of already defined NPCs. Defaults to None.
 
-                                            Some names of already defined npcs include: {other_names} (either find unique names or only if occupationally/characteristically interesting then make a relation of some sort. Most of the times do not do something like this and instead make an indepedent new character.)
-                                            Find a name starting with {str(np.random.choice([i for i in "abcdefghijklmnopqrstuvwxyz"]))}
-                                            """}  # User message containing the game details, NPC characteristics, names of other NPCs, and a random starting letter for the name
-            ]
-        client = OpenAI(api_key=self.api_key)  # Create an OpenAI client instance with the provided API key
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",  # Specify the GPT-3.5 model to use
+        Returns:
+            list: The chat messages for the OpenAI API.
+        """
+        user_content = self._prompt_prefix  # Start from the game details and NPC characteristics, formatted once per NPC
+        if other_names is not None:  # If other NPCs are already defined
+            user_content += f"""
+                                            Some names of already defined npcs include: {other_names} (either find unique names or only if occupationally/characteristically interesting then make a relation of some sort. Most of the times do not do something like this and instead make an indepedent new character.)"""  # Add the names of the other NPCs
+        user_content += f"""
+                                            Find a name starting with {random.choice(_ALPHA)}
+                                            """  # Add a random starting letter for the name
+        messages = [
+            {"role": "system", "content": "Generate character details for an NPC based on the provided persona, occupation, and motivating factor."},  # System message to set the context for the API request
+            {"role": "user", "content": user_content}  # User message containing the game details, NPC characteristics, names of other NPCs, and a random starting letter for the name
+        ]
+        return messages  # Return the messages list
+
+    def generate_character_details(self, other_names=None):
+        """
+        Generate character details for the NPC using the OpenAI API.
+
+        Args:
+            other_names (list, optional): A list of names of already defined NPCs. Defaults to None.
+
+        Returns:
+            dict: A dictionary containing the generated character details.
+        """
+        response = self.client.chat.completions.with_raw_response.create(
+            model="gpt-4o-mini",  # Specify the GPT-4o mini model to use (structured outputs need it)
+            messages=self.character_details_messages(other_names),  # Pass the messages list to the API
+            temperature=0.7,  # Set the temperature for generating diverse character details
+            extra_body=structured_outputs["npc_character_sheet"],  # Request a structured output matching the npc_character_sheet schema
+        )  # Call the OpenAI API to generate character details
+        json_string = raw_structured_output(response)  # Extract the structured output from the raw API response
+        return load_structured_output(json_string, "npc_character_sheet", self.client)  # Parse the JSON string into a dictionary
+
+    def stream_character_details(self, other_names=None):
+        """
+        Stream the character details for the NPC from the OpenAI API, so fields such as the name can be used before the rest is generated.
+
+        Args:
+            other_names (list, optional): A list of names of already defined NPCs. Defaults to None.
+
+        Yields:
+            dict: The character details generated so far, followed by the complete character details.
+        """
+        messages = self.character_details_messages(other_names)  # Build the messages for the API request
+        response = self.client.chat.completions.create(
+            model="gpt-4o-mini",  # Specify the GPT-4o mini model to use (structured outputs need it)
             messages=messages,  # Pass the messages list to the API
             temperature=0.7,  # Set the temperature for generating diverse character details
-            functions=function_templates,  # Pass the function templates to the API
-            function_call={"name": "npc_character_sheet"},  # Specify the function to call (npc_character_sheet)
+            extra_body=structured_outputs["npc_character_sheet"],  # Request a structured output matching the npc_character_sheet schema
+            stream=True,  # Stream the response so fields are available while the rest is generated
+        )  # Call the OpenAI API to generate character details
+        yield from stream_structured_output(response, "npc_character_sheet", self.client)  # Publish the character details as they are parsed
+
+    async def agenerate_character_details(self, async_client, other_names=None):
+        """
+        Asynchronously generate character details for the NPC using the OpenAI API.
+
+        Args:
+            async_client (AsyncOpenAI): The async OpenAI client used for the API request.
+            other_names (list, optional): A list of names of already defined NPCs. Defaults to None.
+
+        Returns:
+            dict: A dictionary containing the generated character details.
+        """
+        response = await async_client.chat.completions.with_raw_response.create(
+            model="gpt-4o-mini",  # Specify the GPT-4o mini model to use (structured outputs need it)
+            messages=self.character_details_messages(other_names),  # Pass the messages list to the API
+            temperature=0.7,  # Set the temperature for generating diverse character details
+            extra_body=structured_outputs["npc_character_sheet"],  # Request a structured output matching the npc_character_sheet schema
         )  # Call the OpenAI API to generate character details
-        json_string = response.choices[0].message.function_call.arguments  # Extract the function call arguments from the API response
-        dictionary = json.loads(json_string)  # Parse the JSON string into a dictionary
-        return dictionary  # Return the dictionary containing the generated character details
+        json_string = raw_structured_output(response)  # Extract the structured output from the raw API response
+        return await aload_structured_output(json_string, "npc_character_sheet", async_client)  # Parse the JSON string into a dictionary
 
     def add_to_memory(self, conversation):
         """
         Add a conversation to the NPC's memory.
 
+        Only the 8 most recent messages are kept as-is. Older messages are folded into the running summary in the background, so this returns without waiting for the OpenAI API.
+
         Args:
             conversation (list): A list of conversation messages.
         """
-        self.memory.extend(conversation)  # Extend the NPC's memory with the conversation messages
-        if len(self.memory) > 8:  # If the memory exceeds 8 messages
-            self.batch_summarize()  # Perform batch summarization of the memory
+        with self._memory_lock:
+            for message in conversation:  # Loop through the conversation messages
+                if len(self.short_term) == self.short_term.maxlen:  # If the window is full
+                    self._evicted.append(self.short_term[0])  # Keep the message that is about to leave the window for the summary
+                self.short_term.append(message)  # Add the message to the window
+            if self._evicted and (self._summarize_future is None or self._summarize_future.done()):  # If messages need summarizing and no summarization is already pending
+                self._summarize_future = _summary_executor.submit(self.batch_summarize)  # Fold the evicted messages into the summary in the background
+
+    def get_memory(self):
+        """
+        Get the NPC's memory, waiting for any pending background summarization first.
+
+        Returns:
+            list: The summary of older messages (if any), followed by the messages not yet summarized and the recent messages.
+
+        Raises:
+            Exception: The API error of a failed background summarization, raised once. Its messages stay in memory and are summarized again later.
+        """
+        future = self._summarize_future  # Take the summarization that was started, if any
+        if future is not None:
+            try:
+                future.result()  # Wait for it to finish (re-raises any API error)
+            finally:
+                with self._memory_lock:
+                    if self._summarize_future is future:  # If no newer summarization was started meanwhile
+                        self._summarize_future = None  # Forget the finished summarization so its error is only raised once
+        with self._memory_lock:
+            summary = [self.long_term_summary] if self.long_term_summary else []  # The running summary, if there is one
+            return summary + self._evicted + list(self.short_term)  # Return a copy of the memory
 
     def batch_summarize(self):
         """
-        Summarize the NPC's conversation history using the OpenAI API.
+        Fold the messages that left the recent-message window into the running summary using the OpenAI API.
+
+        Only the newly evicted messages are sent along with the previous summary, so each call costs the same no matter how long the game runs.
         """
+        with self._memory_lock:
+            evicted, self._evicted = self._evicted, []  # Take the messages to summarize
+            prior_summary = self.long_term_summary  # Take the current summary
+        if not evicted:  # If there is nothing new to summarize
+            return
+        new_events = "\n".join(evicted)  # Join the evicted messages, one per line
         messages = [
-            {"role": "system", "content": "Summarize the provided conversation history into a concise summary."},  # System message to set the context for the API request
-            {"role": "user", "content": f"Conversation history:\n{chr(10).join(self.memory)}\nPlease provide a concise summary of the conversation history."}  # User message containing the conversation history
+            {"role": "system", "content": "Update the provided summary of a conversation history with the new events into a concise summary."},  # System message to set the context for the API request
+            {"role": "user", "content": f"Prior summary: {prior_summary}\nNew events:\n{new_events}\nUpdate summary."}  # User message containing the prior summary and the evicted messages
         ]
-        client = OpenAI(api_key=self.api_key)  # Create an OpenAI client instance with the provided API key
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",  # Specify the GPT-3.5 model to use
-            messages=messages,  # Pass the messages list to the API
-            temperature=0  # Set the temperature to 0 for deterministic output
-        )  # Call the OpenAI API to generate a summary of the conversation history
-        summary = response.choices[0].message.content  # Extract the generated summary from the API response
-        self.memory = [summary]  # Update the NPC's memory with the summary
+        try:
+            response = self.client.chat.completions.with_raw_response.create(
+                model="gpt-4o-mini",  # Specify the GPT-4o mini model to use
+                messages=messages,  # Pass the messages list to the API
+                temperature=0  # Set the temperature to 0 for deterministic output
+            )  # Call the OpenAI API to update the summary of the conversation history
+        except Exception:
+            with self._memory_lock:
+                self._evicted = evicted + self._evicted  # Put the messages back so the next summarization retries them
+            raise
+        summary = raw_message(response)["content"]  # Extract the updated summary from the raw API response
+        with self._memory_lock:
+            self.long_term_summary = summary  # Store the updated summary
+
+    def relation_messages(self, other_npc, extra_context=None):
+        """
+        Build the chat messages for determining the relationship between the NPC and another NPC.
+
+        Args:
+            other_npc (NPC): The other NPC object.
+            extra_context (str, optional): Extra context for the relationship. Defaults to None.
+
+        Returns:
+            list: The chat messages for the OpenAI API.
+        """
+        context = f"Context of relationship from their perspective:\n{extra_context}\n\n" if extra_context is not None else ""  # Extra context for the relationship, if any
+        messages = [
+            {"role": "system", "content": "Analyze the provided character sheets and determine the relationship between the two NPCs."},  # System message to set the context for the API request
+            {"role": "user", "content": f"NPC 1:\n{self._relation_block}\n\nNPC 2:\n{other_npc._relation_block}\n\n{context}Based on the provided information, please determine the relationship between the two NPCs from NPC 1 - i.e. {self.name}'s perspective."}  # User message containing the character sheets of the two NPCs and the optional extra context
+        ]
+        return messages  # Return the messages list
 
     def set_relation(self, other_npc, extra_context=None):
         """
@@ -238,71 +773,53 @@ class NPC:
             other_npc (NPC): The other NPC object.
             extra_context (str, optional): Extra context for the relationship. Defaults to None.
         """
-        if extra_context is None:
-            messages = [
-                {"role": "system", "content": "Analyze the provided character sheets and determine the relationship between the two NPCs."},
-                {"role": "user", "content": f"""NPC 1:
-                                            Name: {self.name}
-                                            TLDR: {self.tldr}
-                                            Speech Pattern: {self.speech_pattern}
-                                            Motivation: {self.motivation}
-                                            Character Sheet: {json.dumps(self.character_sheet)}
-
-                                            NPC 2:
-                                            Name: {other_npc.name}
-                                            TLDR: {other_npc.tldr}
-                                            Speech Pattern: {other_npc.speech_pattern}
-                                            Motivation: {other_npc.motivation}
-                                            Character Sheet: {json.dumps(other_npc.character_sheet)}
-                                            
-                                        Based on the provided information, please determine the relationship between the two NPCs from NPC 1 - i.e. {self.name}'s perspective.
-            """}  # User message containing the character sheets of the two NPCs
-        ]
-        else:
-            messages = [
-                {"role": "system", "content": "Analyze the provided character sheets and determine the relationship between the two NPCs."},  # System message to set the context for the API request
-                {"role": "user", "content": f"""NPC 1:
-                                        Name: {self.name}
-                                        TLDR: {self.tldr}
-                                        Speech Pattern: {self.speech_pattern}
-                                        Motivation: {self.motivation}
-                                        Character Sheet: {json.dumps(self.character_sheet)}
-                                        
-                                        NPC 2:
-                                        Name: {other_npc.name}
-                                        TLDR: {other_npc.tldr}
-                                        Speech Pattern: {other_npc.speech_pattern}
-                                        Motivation: {other_npc.motivation}
-                                        Character Sheet: {json.dumps(other_npc.character_sheet)}
-
-                                        Context of relationship from their perspective:
-
-                                        {extra_context}
-                                        
-                                        Based on the provided information, please determine the relationship between the two NPCs from NPC 1 - i.e. {self.name}'s perspective.
-            """}  # User message containing the character sheets of the two NPCs and extra context for the relationship
-            ]
-        client = OpenAI(api_key=self.api_key)  # Create an OpenAI client instance with the provided API key
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",  # Specify the GPT-3.5 model to use
+        messages = self.relation_messages(other_npc, extra_context)  # Build the messages for the API request
+        response = self.client.chat.completions.with_raw_response.create(
+            model="gpt-4o-mini",  # Specify the GPT-4o mini model to use (structured outputs need it)
             messages=messages,  # Pass the messages list to the API
             temperature=0.7,  # Set the temperature for generating diverse relationship details
-            functions=function_templates,  # Pass the function templates to the API
-            function_call={"name": "npc_relationship_sheet"},  # Specify the function to call (npc_relationship_sheet)
+            extra_body=structured_outputs["npc_relationship_sheet"],  # Request a structured output matching the npc_relationship_sheet schema
         )  # Call the OpenAI API to determine the relationship between the two NPCs
-        json_string = response.choices[0].message.function_call.arguments  # Extract the function call arguments from the API response
-        dictionary = json.loads(json_string)  # Parse the JSON string into a dictionary
+        json_string = raw_structured_output(response)  # Extract the structured output from the raw API response
+        dictionary = load_structured_output(json_string, "npc_relationship_sheet", self.client)  # Parse the JSON string into a dictionary
         self.relations[other_npc.name] = dictionary  # Store the relationship dictionary in the NPC's relations dictionary with the other NPC's name as the key
 
-    def export_npc(self, output_directory):
+    async def aset_relation(self, other_npc, async_client, extra_context=None):
+        """
+        Asynchronously set the relationship between the NPC and another NPC using the OpenAI API.
+
+        Args:
+            other_npc (NPC): The other NPC object.
+            async_client (AsyncOpenAI): The async OpenAI client used for the API request.
+            extra_context (str, optional): Extra context for the relationship. Defaults to None.
+        """
+        response = await async_client.chat.completions.with_raw_response.create(
+            model="gpt-4o-mini",  # Specify the GPT-4o mini model to use (structured outputs need it)
+            messages=self.relation_messages(other_npc, extra_context),  # Pass the messages list to the API
+            temperature=0.7,  # Set the temperature for generating diverse relationship details
+            extra_body=structured_outputs["npc_relationship_sheet"],  # Request a structured output matching the npc_relationship_sheet schema
+        )  # Call the OpenAI API to determine the relationship between the two NPCs
+        json_string = raw_structured_output(response)  # Extract the structured output from the raw API response
+        self.relations[other_npc.name] = await aload_structured_output(json_string, "npc_relationship_sheet", async_client)  # Store the relationship dictionary with the other NPC's name as the key
+
+    def export_file_stem(self):
+        """
+        Get the file name (without extension) the NPC is exported to by default.
+
+        Returns:
+            str: The NPC's name with every character other than a letter replaced by an underscore.
+        """
+        return _UNSAFE_NAME_CHARACTERS.sub('_', self.name)  # Replace the characters that are unsafe in file names
+
+    def export_npc(self, output_directory, file_stem=None):
         """
         Export the NPC data to a JSON file in the specified output directory.
 
         Args:
             output_directory (str): The directory where the NPC JSON file will be saved.
+            file_stem (str, optional): The file name without extension, to keep NPCs whose names clean to the same string apart. Defaults to export_file_stem().
         """
-        if not os.path.exists(output_directory):  # If the output directory doesn't exist
-            os.makedirs(output_directory)  # Create the output directory
+        os.makedirs(output_directory, exist_ok=True)  # Create the output directory if it doesn't exist
         npc_data = {
             "name": self.name,
             "tldr": self.tldr,
@@ -311,6 +828,67 @@ class NPC:
             "character_sheet": self.character_sheet,
             "relations": self.relations
         }  # Create a dictionary containing the NPC data
-        file_path = os.path.join(output_directory, f"{re.sub('[^a-zA-Z]', '_', self.name)}.json")  # Generate the file path for the NPC JSON file
-        with open(file_path, "w") as file:  # Open the file in write mode
-            json.dump(npc_data, file, indent=4)  # Write the NPC data to the JSON file with indentation for readability
\ No newline at end of file
+        if file_stem is None:  # If no file name was given
+            file_stem = self.export_file_stem()  # Derive the file name from the NPC's name
+        file_path = os.path.join(output_directory, f"{file_stem}.json")  # Generate the file path for the NPC JSON file
+        Path(file_path).write_bytes(orjson.dumps(npc_data, option=orjson.OPT_INDENT_2))  # Write the NPC data to the JSON file in one call with indentation for readability
+
+    def set_relations(self, other_npcs):
+        """
+        Set the relationships between the NPC and several other NPCs using a single OpenAI API call.
+
+        Any NPC missing from the response falls back to its own set_relation call.
+
+        Args:
+            other_npcs (list): A list of the other NPC objects.
+        """
+        if not other_npcs:  # If there are no other NPCs
+            return  # Nothing to relate to
+        other_sheets = "\n\n".join(other_npc._relation_block for other_npc in other_npcs)  # Character sheets of every other NPC
+        messages = [
+            {"role": "system", "content": "Analyze the provided character sheets and determine the relationship between NPC 1 and each of the other NPCs."},  # System message to set the context for the API request
+            {"role": "user", "content": f"NPC 1:\n{self._relation_block}\n\nOther NPCs:\n{other_sheets}\n\nBased on the provided information, please determine the relationship between NPC 1 and every one of the other NPCs from NPC 1 - i.e. {self.name}'s perspective. Use the exact name of each other NPC as target_name."}  # User message containing the character sheets of all the NPCs
+        ]
+        response = self.client.chat.completions.with_raw_response.create(
+            model="gpt-4o-mini",  # Specify the GPT-4o mini model to use (structured outputs need it)
+            messages=messages,  # Pass the messages list to the API
+            temperature=0.7,  # Set the temperature for generating diverse relationship details
+            extra_body=structured_outputs["npc_relationship_matrix"],  # Request a structured output matching the npc_relationship_matrix schema
+        )  # Call the OpenAI API to determine the relationships to all the other NPCs
+        json_string = raw_structured_output(response)  # Extract the structured output from the raw API response
+        dictionary = load_structured_output(json_string, "npc_relationship_matrix", self.client)  # Parse the JSON string into a dictionary
+        other_names = {other_npc.name for other_npc in other_npcs}  # Names of the NPCs asked about
+        related_names = set()  # Names of the NPCs the response covered
+        for relation in dictionary["relations"]:  # Loop through the returned relationships
+            target_name = relation.pop("target_name")  # Take the other NPC's name out of the relationship details
+            if target_name in other_names:  # Ignore names the model made up
+                self.relations[target_name] = relation  # Store the relationship dictionary with the other NPC's name as the key
+                related_names.add(target_name)  # Mark the other NPC as covered
+        for other_npc in other_npcs:  # Loop through the other NPCs
+            if other_npc.name not in related_names:  # If the response skipped this NPC
+                self.set_relation(other_npc)  # Fall back to a single relationship call
+
+async def build_world(configs, api_key, max_concurrency=20):
+    """
+    Create several NPCs and the relationships between every pair of them concurrently.
+
+    Args:
+        configs (list): A list of dictionaries with the game_details, persona, occupation, motivating_factor, and optional names of each NPC.
+        api_key (str): The API key for accessing the OpenAI API.
+        max_concurrency (int, optional): The maximum number of concurrent API requests, to respect rate limits. Defaults to 20.
+
+    Returns:
+        list: The created NPC objects, in the order of the configs.
+    """
+    from openai import AsyncOpenAI  # Import openai on first use so importing npc stays fast
+
+    semaphore = asyncio.Semaphore(max_concurrency)  # Limit the number of concurrent API requests
+
+    async def bounded(awaitable):
+        async with semaphore:  # Wait for a free request slot
+            return await awaitable  # Run the API request
+
+    async with AsyncOpenAI(api_key=api_key) as async_client:  # Share one async client (and its connection pool) across all the requests
+        npcs = await asyncio.gather(*(bounded(NPC.acreate(api_key=api_key, async_client=async_client, **config)) for config in configs))  # Create all the NPCs concurrently
+        await asyncio.gather(*(bounded(npc.aset_relation(other_npc, async_client)) for npc in npcs for other_npc in npcs if other_npc is not npc))  # Set the relationship of every NPC to every other NPC concurrently
+    return list(npcs)  # Return the created NPCs